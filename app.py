@@ -1,14 +1,28 @@
 import os
-import json
-from flask import Flask, jsonify, request, render_template
+import time
+import queue
+import atexit
+import logging
+import orjson
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
+from itertools import chain
+from threading import Lock, Thread
+from flask import Flask, Response, jsonify, request, render_template
 from toolbox_langchain import ToolboxClient
 from dotenv import load_dotenv
+from fastpath import first_item, image_urls, merge_product, safe_decode_data, safe_load_tool_result
 from datetime import datetime
 from google import genai
 
 # Load environment variables (including MONGODB_CONNECTION_STRING and server URL)
 load_dotenv()
 
+# Set LOG_LEVEL=WARNING in production to silence per-request debug/info output
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper())
+logger = logging.getLogger(__name__)
+
 # --- Setup ---
 
 # Define fallback GCS Base URL (assuming GCS_PRODUCT_BUCKET is in environment)
@@ -17,6 +31,10 @@ GCS_BASE_URL = f"https://storage.googleapis.com/{GCS_BUCKET_NAME}"
 FALLBACK_IMAGE_URL = os.getenv('FALLBACK_IMAGE_URL')
 
 
+# Thumbnail URL template used by the analytics views
+THUMB_TMPL = (GCS_BASE_URL + "/thumbnails/{}.jpg").format
+
+
 # Initialize the MCP Toolbox Client
 # This client communicates with the running MCP Toolbox Server (usually on localhost:5000)
 TOOLBOX_URL = os.getenv("MCP_TOOLBOX_SERVER_URL")
@@ -25,124 +43,231 @@ if not TOOLBOX_URL:
 
 try:
     toolbox = ToolboxClient(TOOLBOX_URL)
-    print(f"-> MCP Client: Connected to {TOOLBOX_URL}")
-    #print(result)
+    logger.info("-> MCP Client: Connected to %s", TOOLBOX_URL)
 except Exception as e:
     print(f"FATAL ERROR: Could not connect to MCP Toolbox Server. Is the server running? Error: {e}")
     exit()
 
 
-# Helper function to safely decode data received from the MCP client
-def safe_decode_data(data):
-    if isinstance(data, str):
-        try:
-            return json.loads(data)
-        except json.JSONDecodeError:
-            print(f"Warning: Failed to decode JSON string: {data[:50]}...")
-            return None
-    return data 
+# MCP tools used by the routes below. Handles are loaded once and reused across requests.
+TOOL_NAMES = [
+    "get_product_core_data",
+    "get_product_cores_by_ids",
+    "get_product_details",
+    "get_product_stats_by_category",
+    "list_products_core",
+    "list_all_product_details",
+    "insert_user_interaction",
+    "insert_user_interactions_bulk",
+    "get_total_interactions_count",
+    "execute_sql_tool",
+    "get_top_5_views",
+]
 
-app = Flask(__name__)
 
-# --- New Route to Serve the Frontend ---
-@app.route('/')
-def index():
-    """Renders the main product catalog page."""
-    return render_template('index.html')
+# Lazy loader, used for any tool that could not be preloaded at startup
+@lru_cache(maxsize=None)
+def _tool(name):
+    return toolbox.load_tool(name)
 
-# --- Routes ---
 
-@app.route('/products/<product_id>', methods=['GET'])
-def get_product(product_id):
-    """
-    Retrieves a complete product by combining core data (AlloyDB) and details (MongoDB).
-    Uses safe decoding to handle string/list/dict variability from MCP tool output.
-    """
-    
-    raw_core = None
-    raw_details = None
+class _ToolRegistry(dict):
+    def __missing__(self, name):
+        return _tool(name)
+
+
+TOOLS = _ToolRegistry()
+for name in TOOL_NAMES:
+    try:
+        TOOLS[name] = _tool(name)
+    except Exception as e:
+        print(f"Warning: Could not preload MCP tool '{name}', it will be loaded on first use. Error: {e}")
+
 
-    # --- 1. FETCH CORE TRANSACTIONAL DATA (AlloyDB) ---
+# Shared worker pool for overlapping independent MCP tool calls (network-bound).
+# Sized to the request threads per worker (gunicorn --threads, see Dockerfile) so each
+# in-flight request can have one call running alongside its own thread.
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', 32))
+EXECUTOR = ThreadPoolExecutor(max_workers=WORKER_THREADS)
+
+
+# Fetches the core transactional record (AlloyDB) for a single product
+def _fetch_core(product_id):
     try:
-        core_tool = toolbox.load_tool("get_product_core_data")
+        core_tool = TOOLS["get_product_core_data"]
         raw_core_response = core_tool.invoke({"product_id": product_id})
-        
-        # Safely decode the list result
-        decoded_core_list = safe_decode_data(raw_core_response)
 
-        # Extract the single dictionary (it's the first element in the list)
-        raw_core = decoded_core_list[0] if isinstance(decoded_core_list, list) and decoded_core_list else None
-        
+        # Safely decode the list result and extract the single dictionary
+        return first_item(raw_core_response)
+
     except Exception as e:
         print(f"Warning: AlloyDB core data fetch failed for ID {product_id}. {e}")
+        return None
+
 
-    # --- 2. FETCH FLEXIBLE CATALOG DETAILS (MongoDB) ---
+# Fetches the flexible catalog details (MongoDB) for a single product
+def _fetch_details(product_id):
     try:
-        details_tool = toolbox.load_tool("get_product_details")
+        details_tool = TOOLS["get_product_details"]
         raw_details_response = details_tool.invoke({"product_id": product_id})
-        
-        # Safely decode the list result
-        decoded_details_list = safe_decode_data(raw_details_response)
 
-        # Extract the single dictionary
-        raw_details = decoded_details_list[0] if isinstance(decoded_details_list, list) and decoded_details_list else None
+        # Safely decode the list result and extract the single dictionary
+        return first_item(raw_details_response)
 
     except Exception as e:
         print(f"Warning: MongoDB detail fetch failed for ID {product_id}. {e}")
-    
-    
-    # --- 3. MERGE AND FALLBACK LOGIC ---
-    core_data = {} if not raw_core else raw_core
-    details_data = {} if not raw_details else raw_details
+        return None
 
-    if core_data:
-        # SCENARIO A/C: AlloyDB Hit. Merge details if found.
-        full_product = {**core_data, **details_data} 
-        
-        if not details_data:
-             full_product['source_note'] = 'PARTIAL MODE: MongoDB details missing.'
 
-    elif details_data:
-        # SCENARIO B: AlloyDB Miss, MongoDB Hit (Disjoint Fallback)
-        
-        # Synthesize core fields using MongoDB data
-        synth_core = {
-            'product_id': details_data.get('product_id'),
-            'name': f"MongoDB Product: {details_data.get('category', 'Generic')}", 
-            'price': 39.99, 
-            'sku': details_data.get('sku', 'SYNTH-001'), 
-            'stock': 999,
-            'source_note': 'FALLBACK MODE: Core data synthesized from MongoDB details.'
-        }
-        full_product = {**synth_core, **details_data}
-
-    else:
-        # SCENARIO D: Total Miss
-        return jsonify({"message": f"Product ID {product_id} not found in any data store."}), 404
-        
-    
-    # --- 4. Final Enrichment (GCS Image URL) ---
-    sku = full_product.get('sku', 'N/A')
-    
-    if sku and sku != 'N/A':
-        full_product['image_url'] = f"{GCS_BASE_URL}/{sku}.jpg"
-        full_product['fallback_url'] = FALLBACK_IMAGE_URL
-    else:
-        full_product['image_url'] = FALLBACK_IMAGE_URL
-        full_product['fallback_url'] = FALLBACK_IMAGE_URL
-        
-    
-    return jsonify(full_product)
+# Fetches core records for several products in one round-trip, keyed by product_id
+def _fetch_cores_by_ids(product_ids):
+    try:
+        batch_tool = TOOLS["get_product_cores_by_ids"]
+        cores = safe_load_tool_result(batch_tool.invoke({"product_ids": product_ids}))
+        return {core['product_id']: core for core in cores}
+
+    except Exception as e:
+        logger.warning("Batch core data fetch failed, falling back to parallel lookups. %s", e)
+
+    # Fallback: one lookup per ID, run in parallel instead of serially
+    return dict(zip(product_ids, EXECUTOR.map(_fetch_core, product_ids)))
+
+
+# Resolves a full product by combining core data (AlloyDB) and details (MongoDB).
+# Returns a (status_code, payload) pair shared by both product-detail routes.
+# Candidate for a short-TTL per-product cache if popular items dominate lookups.
+def _resolve_product(product_id):
+    # --- 1 & 2. FETCH CORE (AlloyDB) AND DETAILS (MongoDB) CONCURRENTLY ---
+    # The details fetch runs on the request thread while the core fetch runs on the pool
+    f_core = EXECUTOR.submit(_fetch_core, product_id)
+    raw_details = _fetch_details(product_id)
+    raw_core = f_core.result()
+
+    # --- 3 & 4. MERGE, FALLBACK AND IMAGE ENRICHMENT ---
+    return merge_product(product_id, raw_core, raw_details, GCS_BASE_URL, FALLBACK_IMAGE_URL)
+
+
+app = Flask(__name__)
+
+
+# Serializes large payloads with orjson, bypassing Flask's stdlib-based jsonify
+def json_response(obj, status=200):
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
+
+
+# Constant error responses, encoded once at import time and reused by every request
+RESP_MISSING_PID = json_response({"error": "product_id is required."}, 400)
+RESP_MISSING_TRACKING_PID = json_response({"error": "product_id is required for tracking."}, 400)
+RESP_INVALID_BODY = json_response({"error": "Request body must be a JSON object."}, 400)
+RESP_NO_PRODUCTS = json_response({"message": "No products loaded from any source."}, 500)
+RESP_VIEW_QUEUED = json_response({"message": "Interaction queued for tracking (via MongoDB)."}, 202)
+RESP_TRACKING_BUSY = json_response({"error": "Tracking queue is full, try again later."}, 503)
+
+
+# --- Response Cache (short TTL, stale-while-revalidate) ---
+# Entries stay fresh for the decorator's ttl; after that they are served stale
+# for up to CACHE_STALE_SECONDS while a background refresh recomputes them.
+CACHE_STALE_SECONDS = 300
+CATALOG_CACHE = TTLCache(maxsize=64, ttl=CACHE_STALE_SECONDS)
+CACHE_LOCK = Lock()
+_REFRESHING = set()
+
+# Refreshes get their own pool: the cached views themselves wait on EXECUTOR tasks
+REFRESH_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+
+def _store(key, body, mimetype, ttl):
+    with CACHE_LOCK:
+        CATALOG_CACHE[key] = (time.monotonic() + ttl, body, mimetype)
+
+
+# Stores a streamed body once the last chunk has been sent, without buffering the stream
+def _store_when_done(key, chunks, mimetype, ttl):
+    body = []
+    for chunk in chunks:
+        body.append(chunk)
+        yield chunk
+    _store(key, b''.join(body), mimetype, ttl)
+
+
+# Runs the view and stores its serialized body if it succeeded
+def _render_and_store(key, view, kwargs, ttl):
+    response = app.make_response(view(**kwargs))
+    if response.status_code == 200:
+        if response.is_streamed:
+            response.response = _store_when_done(key, response.response, response.mimetype, ttl)
+        else:
+            _store(key, response.get_data(), response.mimetype, ttl)
+    return response
+
+
+def _schedule_refresh(key, view, kwargs, ttl):
+    with CACHE_LOCK:
+        if key in _REFRESHING:
+            return
+        _REFRESHING.add(key)
+
+    def refresh():
+        try:
+            with app.app_context():
+                # Consume the body so streamed responses are stored too
+                _render_and_store(key, view, kwargs, ttl).get_data()
+        except Exception as e:
+            logger.warning("Background cache refresh failed for %s. %s", key, e)
+        finally:
+            with CACHE_LOCK:
+                _REFRESHING.discard(key)
+
+    REFRESH_EXECUTOR.submit(refresh)
+
+
+def cached_response(ttl=30):
+    """Caches a GET view's serialized response, keyed by path and query string."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            key = request.path + '?' + request.query_string.decode()
+            with CACHE_LOCK:
+                entry = CATALOG_CACHE.get(key)
+
+            if entry is None:
+                return _render_and_store(key, view, kwargs, ttl)
+
+            fresh_until, body, mimetype = entry
+            if time.monotonic() > fresh_until:
+                _schedule_refresh(key, view, kwargs, ttl)
+            return app.response_class(body, mimetype=mimetype)
+        return wrapper
+    return decorator
+
+
+# --- New Route to Serve the Frontend ---
+@app.route('/')
+def index():
+    """Renders the main product catalog page."""
+    return render_template('index.html')
+
+# --- Routes ---
+
+@app.route('/products/<product_id>', methods=['GET'])
+def get_product(product_id):
+    """
+    Retrieves a complete product by combining core data (AlloyDB) and details (MongoDB).
+    Uses safe decoding to handle string/list/dict variability from MCP tool output.
+    """
+    status, payload = _resolve_product(product_id)
+    return json_response(payload, status)
 
 
 
 @app.route('/inventory/<category>', methods=['GET'])
+@cached_response(ttl=30)
 def get_category_inventory_stats(category):
     """
     Demonstrates using a single MongoDB Aggregation tool for analytics.
     """
     try:
-        stats_tool = toolbox.load_tool("get_product_stats_by_category")
+        stats_tool = TOOLS["get_product_stats_by_category"]
         # The tool requires no parameters, so we invoke with an empty dictionary
         stats_data = stats_tool.invoke({"category": category})
         
@@ -154,61 +279,37 @@ def get_category_inventory_stats(category):
     except Exception as e:
         return jsonify({"error": "Failed to run category aggregation tool.", "details": str(e)}), 500
 
-# --- Helper to safely load results from MCP tool ---
-def safe_load_tool_result(result):
-    if isinstance(result, str):
-        try:
-            return json.loads(result)
-        except json.JSONDecodeError:
-            print(f"Error: Could not decode JSON string from tool result.")
-            return []
-    return result if isinstance(result, list) else []
 
 
+# Invokes a no-argument catalog listing tool (runs on the shared executor)
+def _fetch_catalog(tool_name):
+    return safe_load_tool_result(TOOLS[tool_name].invoke({}))
 
 
-@app.route('/products', methods=['GET'])
-def list_products():
-    """
-    Fetches ALL products by concatenating the disjoint AlloyDB and MongoDB catalogs,
-    and enriches each item independently.
-    """
-    
-    final_catalog = []
-    
-    # --- 1. PROCESS ALLOYDB DATA (Core Catalog) ---
+# Yields enriched AlloyDB catalog items once the pending fetch completes
+def _iter_alloydb(catalog_future):
     try:
-        list_tool = toolbox.load_tool("list_products_core")
-        alloydb_products = safe_load_tool_result(list_tool.invoke({}))
+        alloydb_products = catalog_future.result()
         
         for product in alloydb_products:
-            sku = product.get('sku')
-            
             # Enrich with GCS URL based on AlloyDB SKU
             product['source'] = 'AlloyDB (Core)'
-            if sku:
-                product['image_url'] = f"{GCS_BASE_URL}/{sku}.jpg"
-                # You'd use get_fallback_image(sku) here if the function were defined, 
-                # but using a static URL for robustness:
-                product['fallback_url'] = FALLBACK_IMAGE_URL 
-            else:
-                product['image_url'] = FALLBACK_IMAGE_URL
-                product['fallback_url'] = FALLBACK_IMAGE_URL
+            product['image_url'], product['fallback_url'] = image_urls(product.get('sku'), GCS_BASE_URL, FALLBACK_IMAGE_URL)
             
-            final_catalog.append(product)
+            yield product
 
     except Exception as e:
         print(f"Error fetching AlloyDB catalog: {e}")
         # We allow the application to proceed even if one source fails
 
-    # --- 2. PROCESS MONGODB DATA (Disjoint Catalog Details) ---
+
+# Yields enriched MongoDB catalog items once the pending fetch completes
+def _iter_mongo(catalog_future):
     try:
-        details_tool = toolbox.load_tool("list_all_product_details")
-        mongodb_products = safe_load_tool_result(details_tool.invoke({}))
-        print(mongodb_products)
+        mongodb_products = catalog_future.result()
+        logger.debug("MongoDB catalog products count=%d", len(mongodb_products))
         for product in mongodb_products:
             # Note: MongoDB documents must have 'product_id' and 'sku' for this to work well
-            sku = product.get('sku') 
             product['name'] = product.get('category')
             product['price'] = 39.99
          
@@ -216,72 +317,179 @@ def list_products():
             # Label the source clearly
             product['source'] = 'MongoDB (Details)'
             
-            # Enrich with image data
-            if sku:
-                product['image_url'] = f"{GCS_BASE_URL}/{sku}.jpg"
-                product['fallback_url'] = FALLBACK_IMAGE_URL
-            else:
-                # If MongoDB data has no SKU, use the placeholder image
-                product['image_url'] = FALLBACK_IMAGE_URL
-                product['fallback_url'] = FALLBACK_IMAGE_URL
+            # Enrich with image data (placeholder image if MongoDB data has no SKU)
+            product['image_url'], product['fallback_url'] = image_urls(product.get('sku'), GCS_BASE_URL, FALLBACK_IMAGE_URL)
             
-            final_catalog.append(product)
+            yield product
 
     except Exception as e:
         print(f"Error fetching MongoDB catalog: {e}")
         # Allow the application to proceed
 
-    # --- 3. FINAL OUTPUT ---
-    if not final_catalog:
-         return jsonify({"message": "No products loaded from any source."}), 500
 
-    return jsonify(final_catalog)
+@app.route('/products', methods=['GET'])
+@cached_response(ttl=30)
+def list_products():
+    """
+    Fetches ALL products by concatenating the disjoint AlloyDB and MongoDB catalogs,
+    and enriches each item independently.
+    Both catalogs are fetched concurrently and the result is streamed as a JSON array.
+    """
+    
+    # --- 1. FETCH BOTH CATALOGS CONCURRENTLY (AlloyDB + MongoDB) ---
+    f_alloydb = EXECUTOR.submit(_fetch_catalog, "list_products_core")
+    f_mongo = EXECUTOR.submit(_fetch_catalog, "list_all_product_details")
+
+    # --- 2. ENRICH LAZILY, ALLOYDB ITEMS FIRST ---
+    catalog = chain(_iter_alloydb(f_alloydb), _iter_mongo(f_mongo))
+
+    # Peek at the first item so a total miss can still be reported with a 500
+    first = next(catalog, None)
+    if first is None:
+         return RESP_NO_PRODUCTS
+
+    # --- 3. FINAL OUTPUT (streamed, one product serialized at a time) ---
+    def generate():
+        yield b'[' + orjson.dumps(first)
+        for product in catalog:
+            yield b',' + orjson.dumps(product)
+        yield b']'
+
+    return Response(generate(), mimetype='application/json')
         
 
 
 
+# Second-resolution UTC ISO timestamp, formatted at most once per second
+_ts_cache = {'sec': 0, 'str': ''}
+
+def _utc_timestamp():
+    sec = int(time.time())
+    if sec != _ts_cache['sec']:
+        _ts_cache['str'] = datetime.utcfromtimestamp(sec).isoformat()
+        _ts_cache['sec'] = sec
+    return _ts_cache['str']
+
+
+# --- Write-behind buffer for view events ---
+# Events are queued by /track/view and inserted by one background thread, up to
+# VIEW_BATCH_SIZE documents per call or whatever arrived within VIEW_FLUSH_SECONDS.
+VIEW_BATCH_SIZE = 500
+VIEW_FLUSH_SECONDS = 0.1
+VIEW_QUEUE = queue.Queue(maxsize=10000)
+
+# Single inserts (used when the bulk tool is not deployed) fan out over this pool
+VIEW_INSERT_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+# Set once the bulk tool fails to load, so later batches skip the load attempt
+_bulk_insert_unavailable = False
+
+
+def _next_view_batch():
+    batch = [VIEW_QUEUE.get()]  # Block until at least one event arrives
+    deadline = time.monotonic() + VIEW_FLUSH_SECONDS
+    while len(batch) < VIEW_BATCH_SIZE:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(VIEW_QUEUE.get(timeout=timeout))
+        except queue.Empty:
+            break
+    return batch
+
+
+def _insert_view(insert_tool, doc):
+    try:
+        insert_tool.invoke({"data": orjson.dumps(doc).decode()})
+    except Exception as e:
+        logger.error("Error while recording user interaction: %s", e)
+
+
+def _write_views(batch):
+    global _bulk_insert_unavailable
+
+    if not _bulk_insert_unavailable:
+        try:
+            bulk_tool = TOOLS["insert_user_interactions_bulk"]
+        except Exception as e:
+            logger.warning("Bulk interaction insert tool unavailable, using single inserts. %s", e)
+            _bulk_insert_unavailable = True
+        else:
+            # No per-document fallback here: a failed (or timed-out) insert-many may have
+            # written part or all of the batch, and re-sending would double-count views
+            try:
+                response = bulk_tool.invoke({"data": orjson.dumps(batch).decode()})
+                logger.debug("Interactions tracked: count=%d %s", len(batch), response)
+            except Exception as e:
+                logger.error("Bulk interaction insert failed for %d events: %s", len(batch), e)
+            return
+
+    try:
+        insert_tool = TOOLS["insert_user_interaction"]
+    except Exception as e:
+        logger.error("Error while recording user interactions: %s. Dropped %d events.", e, len(batch))
+        return
+
+    # Consume the results so the writer waits for this batch before taking the next
+    list(VIEW_INSERT_EXECUTOR.map(lambda doc: _insert_view(insert_tool, doc), batch))
+
+
+def _view_writer():
+    while True:
+        _write_views(_next_view_batch())
+
+
+# Flush whatever is still buffered when the process exits
+@atexit.register
+def _flush_views():
+    batch = []
+    while True:
+        try:
+            batch.append(VIEW_QUEUE.get_nowait())
+        except queue.Empty:
+            break
+    if batch:
+        _write_views(batch)
+
+
+Thread(target=_view_writer, name="view-writer", daemon=True).start()
+
+
 @app.route('/track/view', methods=['POST'])
 def track_user_view():
     """
     Records a user product view event to MongoDB (via MCP Tool).
-    This is a high-volume write operation.
+    This is a high-volume write operation, so events are buffered and inserted in batches.
     """
-    data = request.json
+    # Parse the body with orjson rather than Flask's stdlib-based request.json
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
+        return RESP_INVALID_BODY
+
     # Simple validation and default data
     user_id = data.get('user_id', 'User')
     product_id = data.get('product_id')
     event_type = 'product_view'
     
     if not product_id:
-        return jsonify({"error": "product_id is required for tracking."}), 400
+        return RESP_MISSING_TRACKING_PID
 
+    # Hand the event to the background writer; it is inserted with the next batch
     try:
-        # 1. Load the specific MongoDB insertion tool
-        insert_tool = toolbox.load_tool("insert_user_interaction")
-
-        # 2. Prepare the data as a JSON string
-        data = {
+        VIEW_QUEUE.put_nowait({
             "user_id": user_id,
             "product_id": product_id,
             "details": "User viewed this product.",
-            "timestamp": datetime.utcnow().isoformat()  # Add timestamp
-        }
-        data_json = json.dumps(data)
-
-        # 3. Invoke the tool with the data parameter
-        response = insert_tool.invoke({"data": data_json})
+            "timestamp": _utc_timestamp()  # Add timestamp
+        })
+    except queue.Full:
+        return RESP_TRACKING_BUSY
 
-        # 4. Process the response
-        print(response)
-        
-        return jsonify({
-            "message": "Interaction tracked successfully (via MongoDB).",
-            "inserted_id": response
-        }), 201
-        
-    except Exception as e:
-        print(f"Error while recording user interaction: {e}")
-        return jsonify({"error": "Failed to record user interaction.", "details": str(e)}), 500
+    return RESP_VIEW_QUEUED
 
 
     
@@ -296,87 +504,21 @@ def get_product_by_id():
     product_id = data.get('product_id')
     
     if not product_id:
-        return jsonify({"error": "product_id is required."}), 400
+        return RESP_MISSING_PID
 
-    raw_core = None
-    raw_details = None
+    status, payload = _resolve_product(product_id)
+    return json_response(payload, status)
 
-    # --- 1. FETCH CORE TRANSACTIONAL DATA (AlloyDB) ---
-    try:
-        core_tool = toolbox.load_tool("get_product_core_data")
-        raw_core_response = core_tool.invoke({"product_id": product_id})
-        
-        # Decode the raw response string/list safely
-        decoded_core_list = safe_decode_data(raw_core_response)
 
-        # Extract the dictionary (it's the first element in the list)
-        raw_core = decoded_core_list[0] if isinstance(decoded_core_list, list) and decoded_core_list else None
-        
-    except Exception as e:
-        print(f"Warning: AlloyDB core data fetch failed for ID {product_id}. {e}")
+# Summaries above the threshold are written to BigQuery in batches of ETL_BATCH_SIZE rows
+ETL_BATCH_THRESHOLD = 1000
+ETL_BATCH_SIZE = 500
 
-    # --- 2. FETCH FLEXIBLE CATALOG DETAILS (MongoDB) ---
-    try:
-        details_tool = toolbox.load_tool("get_product_details")
-        raw_details_response = details_tool.invoke({"product_id": product_id})
-        
-        # Decode the raw response string/list safely
-        decoded_details_list = safe_decode_data(raw_details_response)
 
-        # Extract the dictionary (it's the first element in the list)
-        raw_details = decoded_details_list[0] if isinstance(decoded_details_list, list) and decoded_details_list else None
-
-    except Exception as e:
-        print(f"Warning: MongoDB detail fetch failed for ID {product_id}. {e}")
-    
-    
-    # --- 3. MERGE AND FALLBACK LOGIC ---
-
-    core_data = {} if not raw_core else raw_core
-    details_data = {} if not raw_details else raw_details
-
-    # SCENARIO A: Full Merge (The ideal, coherent case) OR SCENARIO C (AlloyDB Hit)
-    if core_data:
-        # Core data is present. Merge any details found.
-        full_product = {**core_data, **details_data} 
-        
-        # Add source note if details were missing
-        if not details_data:
-             full_product['source_note'] = 'PARTIAL MODE: MongoDB details missing.'
-
-    elif details_data:
-        # SCENARIO B: AlloyDB Miss, MongoDB Hit (The Disjoint Fallback)
-        
-        # Synthesize required core fields from MongoDB data
-        synth_core = {
-            'product_id': details_data.get('product_id'),
-            'name': f"MongoDB Product: {details_data.get('category', 'Generic')}", 
-            'price': 39.99, 
-            'sku': details_data.get('sku', 'SYNTH-001'), 
-            'stock': 999,
-            'source_note': 'FALLBACK MODE: Core data synthesized from MongoDB details.'
-        }
-        
-        # Merge synthesized core with rich MongoDB details
-        full_product = {**synth_core, **details_data}
-
-    else:
-        # SCENARIO D: Total Miss
-        return jsonify({"message": f"Product ID {product_id} not found in any data store."}), 404
-        
-    
-    # --- 4. Final Enrichment (GCS Image URL) ---
-    sku = full_product.get('sku', 'N/A')
-    
-    if sku and sku != 'N/A':
-        full_product['image_url'] = f"{GCS_BASE_URL}/{sku}.jpg"
-        full_product['fallback_url'] = FALLBACK_IMAGE_URL
-    else:
-        full_product['image_url'] = FALLBACK_IMAGE_URL
-        full_product['fallback_url'] = FALLBACK_IMAGE_URL
-        
-    
-    return jsonify(full_product)
+def _summary_batches(summary_json):
+    rows = orjson.loads(summary_json)
+    for start in range(0, len(rows), ETL_BATCH_SIZE):
+        yield orjson.dumps(rows[start:start + ETL_BATCH_SIZE]).decode()
 
 
 @app.route('/etl/run', methods=['POST'])
@@ -388,28 +530,46 @@ def run_etl_to_bigquery():
     """
     try:
         # --- 1. READ/EXTRACT/TRANSFORM (MongoDB via MCP) ---
-        mongo_summary_tool = toolbox.load_tool("get_total_interactions_count")
+        mongo_summary_tool = TOOLS["get_total_interactions_count"]
         
         # This returns the aggregated list: [{'product_id': '...', 'interaction_count': N}, ...]
-        summary_data = mongo_summary_tool.invoke({"product_id":""})
-        
-        if not summary_data:
+        # The tool already returns it as a JSON string, which is exactly what the BigQuery
+        # tool's string parameter expects, so it is forwarded without a decode/encode round-trip.
+        raw_summary = mongo_summary_tool.invoke({"product_id":""})
+        if isinstance(raw_summary, (bytes, bytearray)):
+            summary_json = raw_summary.decode()
+        elif isinstance(raw_summary, str):
+            summary_json = raw_summary
+        else:
+            summary_json = orjson.dumps(raw_summary).decode()
+
+        # Each summary row carries exactly one product_id key, so counting keys avoids a full parse
+        products_processed = summary_json.count('"product_id"')
+        
+        if not products_processed:
             return jsonify({"message": "No interaction data to transfer."}), 200
 
         # --- 2. WRITE/LOAD (BigQuery via MCP) ---
-        bq_write_tool = toolbox.load_tool("execute_sql_tool")
+        bq_write_tool = TOOLS["execute_sql_tool"]
         
         # Hardcoded JSON string - THIS IS THE KEY STEP
         #hardcoded_json_string = '[{"interaction_count":1,"product_id":"06523234-2a5c-49fb-b801-e18b72ee3578"}]'
 
 
         # BigQuery tool execution
-        bq_response = bq_write_tool.invoke({"product_summaries": summary_data})
-        print(bq_response)
+        if products_processed > ETL_BATCH_THRESHOLD:
+            # Large summaries are merged in batches to stay under request size limits.
+            # Batches run one after another: concurrent MERGEs into one BigQuery table conflict.
+            for batch_json in _summary_batches(summary_json):
+                bq_response = bq_write_tool.invoke({"product_summaries": batch_json})
+                logger.debug("BigQuery merge response: %s", bq_response)
+        else:
+            bq_response = bq_write_tool.invoke({"product_summaries": summary_json})
+            logger.debug("BigQuery merge response: %s", bq_response)
         
         return jsonify({
             "message": "Application-Driven ETL complete. MongoDB summary merged into BigQuery.",
-            "products_processed": len(summary_data),
+            "products_processed": products_processed,
             "bigquery_response": "success" # Contains job/status details
         }), 200
 
@@ -418,6 +578,8 @@ def run_etl_to_bigquery():
 
 
 
+# Not cached: the UI re-reads the ranking right after /etl/run, and the response cache
+# is per gunicorn worker, so an ETL run could not clear it in the other workers.
 @app.route('/analytics/top5', methods=['GET'])
 def get_top_5_products():
     """
@@ -426,7 +588,7 @@ def get_top_5_products():
     """
     try:
         # 1. Get Top 5 Product IDs and view counts from BigQuery (via MCP)
-        top5_tool = toolbox.load_tool("get_top_5_views")
+        top5_tool = TOOLS["get_top_5_views"]
         top5_response = top5_tool.invoke({})
         
         if not top5_response:
@@ -434,40 +596,25 @@ def get_top_5_products():
 
         # 2. Extract IDs and orchestrate data lookup (AlloyDB + GCS)
         top_products_list = []
-        gcs_base_url = f"https://storage.googleapis.com/{os.getenv('GCS_PRODUCT_BUCKET')}"
-     
-        # Check if top5_response is a string, and if so, parse it as JSON
-        if isinstance(top5_response, str):
-            try:
-                top5_response = json.loads(top5_response)
-            except json.JSONDecodeError as e:
-                return jsonify({"error": "Error decoding JSON response from BigQuery tool.", "details": str(e)}), 500
-        
+
+        # Parse string/bytes responses as JSON (lists pass through unchanged)
+        top5_response = safe_decode_data(top5_response)
+        if top5_response is None:
+            return jsonify({"error": "Error decoding JSON response from BigQuery tool."}), 500
+
+        # Fetch core data (AlloyDB) for all ranked IDs in a single round-trip
+        product_ids = [top_item['product_id'] for top_item in top5_response]
+        cores_by_id = _fetch_cores_by_ids(product_ids)
+
         for top_item in top5_response:
             product_id = top_item['product_id']
-            print(product_id)
-            
-            # Fetch combined data (AlloyDB core + MongoDB details) using existing tool
-            try:
-                core_data_response = toolbox.load_tool("get_product_core_data").invoke({"product_id": product_id})
-                
-                if isinstance(core_data_response, str):
-                    core_data_response = json.loads(core_data_response)
-                
-                # Access the actual core data
-                if core_data_response and isinstance(core_data_response, list) and len(core_data_response) > 0:
-                    core_data = core_data_response[0]
-                else:
-                    core_data = None
-                    print(f"Warning: No core data found for product ID: {product_id}")
-
-            except Exception as e:
-                print(f"Error fetching core data for product ID {product_id}: {e}")
-                core_data = None  # Set to None to prevent further errors
+            core_data = cores_by_id.get(product_id)
+            if not core_data:
+                print(f"Warning: No core data found for product ID: {product_id}")
 
             '''
             try:
-                details_data_response = toolbox.load_tool("get_product_details").invoke({"product_id": product_id})
+                details_data_response = TOOLS["get_product_details"].invoke({"product_id": product_id})
                 print(details_data_response)
 
 
@@ -484,7 +631,7 @@ def get_top_5_products():
                 
                 # Enrich with GCS URL and views
                 product['total_views'] = top_item['interaction_score']  # Use 'interaction_score' instead of 'total_views'
-                product['image_url'] = f"{gcs_base_url}/thumbnails/{product['sku']}.jpg"
+                product['image_url'] = THUMB_TMPL(product['sku'])
                 
                 # Add MongoDB details if available
                 #if details_data:
@@ -492,7 +639,7 @@ def get_top_5_products():
                 
                 top_products_list.append(product)
 
-        return jsonify(top_products_list)
+        return json_response(top_products_list)
         
     except Exception as e:
         return jsonify({"error": "BigQuery Analytics query failed.", "details": str(e)}), 500
@@ -0,0 +1,104 @@
+"""
+Per-request helpers used by the Flask routes in app.py: decoding MCP tool results,
+merging AlloyDB core data with MongoDB details, and GCS image URL enrichment.
+
+This module has no Flask or toolbox imports so it can be compiled with mypyc
+(see Dockerfile). Without a compiled build, the plain Python source is imported.
+"""
+from typing import Any, Optional
+
+import orjson
+
+
+# Helper function to safely decode data received from the MCP client
+def safe_decode_data(data: Any) -> Any:
+    if isinstance(data, (bytes, bytearray, str)):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            print(f"Warning: Failed to decode JSON string: {data[:50]!r}...")
+            return None
+    return data
+
+
+# Returns the first record of a (possibly JSON-encoded) MCP list result.
+# Exact class checks are used instead of isinstance: tool results are plain lists/dicts.
+def first_item(data: Any) -> Any:
+    decoded = safe_decode_data(data)
+    if decoded.__class__ is list:
+        return decoded[0] if decoded else None
+    return decoded if decoded.__class__ is dict else None
+
+
+# --- Helper to safely load results from MCP tool ---
+def safe_load_tool_result(result: Any) -> Any:
+    if isinstance(result, (bytes, bytearray, str)):
+        try:
+            return orjson.loads(result)
+        except orjson.JSONDecodeError:
+            print("Error: Could not decode JSON string from tool result.")
+            return []
+    return result if isinstance(result, list) else []
+
+
+# Returns the (image_url, fallback_url) pair for a product SKU.
+# Values that come straight from request or tool data are typed Any: mypyc enforces
+# annotations at runtime, and these must behave exactly like the uncompiled source.
+def image_urls(sku: Any, base_url: str, fallback_url: Optional[str]) -> tuple[Optional[str], Optional[str]]:
+    if sku and sku != 'N/A':
+        return f"{base_url}/{sku}.jpg", fallback_url
+    return fallback_url, fallback_url
+
+
+def merge_product(
+    product_id: Any,
+    raw_core: Any,
+    raw_details: Any,
+    base_url: str,
+    fallback_url: Optional[str],
+) -> tuple[int, Any]:
+    """
+    Combines core data (AlloyDB) and details (MongoDB) into a full product.
+    Returns a (status_code, payload) pair.
+    """
+    core_data: Any = {} if not raw_core else raw_core
+    details_data: Any = {} if not raw_details else raw_details
+
+    # SCENARIO A: Full Merge (The ideal, coherent case) OR SCENARIO C (AlloyDB Hit)
+    if core_data:
+        # Core data is present. Merge any details found.
+        # core_data was decoded for this request only, so it can be extended in place
+        full_product = core_data
+        if details_data:
+            full_product.update(details_data)
+        else:
+            # Add source note if details were missing
+            full_product['source_note'] = 'PARTIAL MODE: MongoDB details missing.'
+
+    elif details_data:
+        # SCENARIO B: AlloyDB Miss, MongoDB Hit (The Disjoint Fallback)
+
+        # Synthesize required core fields from MongoDB data
+        synth_core: dict[str, Any] = {
+            'product_id': details_data.get('product_id'),
+            'name': f"MongoDB Product: {details_data.get('category', 'Generic')}",
+            'price': 39.99,
+            'sku': details_data.get('sku', 'SYNTH-001'),
+            'stock': 999,
+            'source_note': 'FALLBACK MODE: Core data synthesized from MongoDB details.'
+        }
+
+        # Merge synthesized core with rich MongoDB details
+        synth_core.update(details_data)
+        full_product = synth_core
+
+    else:
+        # SCENARIO D: Total Miss
+        return 404, {"message": f"Product ID {product_id} not found in any data store."}
+
+    # --- Final Enrichment (GCS Image URL) ---
+    full_product['image_url'], full_product['fallback_url'] = image_urls(
+        full_product.get('sku', 'N/A'), base_url, fallback_url
+    )
+
+    return 200, full_product